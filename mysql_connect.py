@@ -1,5 +1,4 @@
 import mysql_secrets as mysqlcreds
-import mysql.connector as mysqlc
 from datetime import date, datetime
 import sys
 import csv
@@ -125,6 +124,10 @@ def export_all(cnx, start_from_scratch=False, ignore_tables_done=False):
         tables_exclude.extend(already_processed.read().splitlines())
     except:
       pass
+  else:
+    # Start the list over, so it only records the tables done in this run (and doesn't keep
+    # growing when this is run over and over, e.g. by the scheduler)
+    open("tables_done.txt", "w").close()
 
   # Go through the BA_Global list and select everything into a big dump
   for tbl, in tables_global:
@@ -377,13 +380,20 @@ ORDER BY {}
 """.format(db_name, tbl, columns, order_by))
 
 
+# Config used to access a db with the specified dbname and hostname.
+def db_config(host, db="BA_Billing"):
+  return {"user": mysqlcreds.user, "password": mysqlcreds.password, "host": host, "database": db}
+
+
 # Establishes a connection to a MySQL database with a specified dbname and hostname.
 # Operation is the function to execute after connecting. Function must take in a connection.
 def connect_to_db(host, db="BA_Billing", operation=daily_routine, **kwargs):
+  # The connector is slow to import, so only load it once we actually connect
+  import mysql.connector as mysqlc
+
   print("Connecting to {} for database \"{}\"...".format(host, db))
 
-  # Config used to access db.
-  config = {"user": mysqlcreds.user, "password": mysqlcreds.password, "host": host, "database": db}
+  config = db_config(host, db)
 
   try:
     connection = mysqlc.connect(**config)
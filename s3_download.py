@@ -1,73 +1,207 @@
 import aws_secrets
 import sys
 import os
-import boto3
 import time
-from botocore.exceptions import ClientError
-from io import BytesIO
+import json
+import mmap
+import tempfile
 import gzip
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, datetime
+from s3_upload import get_s3_client
 
 debugging = False
 
+# Objects are downloaded in byte ranges of this size; anything bigger than one range has the
+# rest of its ranges downloaded in parallel
+range_chunk_size = 8 * 1024 * 1024
+download_workers = 8
 
-# Downloads the gzipped file from s3 and unzips it.
-def download_gzipped(client, bucket, key, fp, compressed_fp=None):
-  # If compressed_fp is None, the compression is performed in memory.
-  if not compressed_fp:
-    compressed_fp = BytesIO()
-  client.download_fileobj(bucket, key, compressed_fp)
-  compressed_fp.seek(0)
-  with gzip.GzipFile(fileobj=compressed_fp, mode='rb') as gz:
-    shutil.copyfileobj(gz, fp)
+# Where sync mode keeps the ETags & Last-Modified times of the objects it downloaded
+sync_cache_file = "s3-sync-cache.json"
+# How many objects import_all syncs between saves of the cache
+sync_cache_save_every = 50
+
+
+# Downloads the remaining byte ranges (from "start" on) of an object with concurrent GETs.
+# The ranges are written straight into compressed_fp, which is preallocated and memory-mapped,
+# and the ETag is checked on every GET so that the pieces can't come from different versions of
+# the object.
+def download_ranges(client, bucket, key, compressed_fp, start, size, etag):
+  compressed_fp.flush()
+  compressed_fp.truncate(size)
+  with mmap.mmap(compressed_fp.fileno(), size) as compressed_map:
+
+    def fetch_range(range_start):
+      range_end = min(range_start + range_chunk_size, size) - 1
+      content_range = "bytes {}-{}/{}".format(range_start, range_end, size)
+      response = client.get_object(Bucket=bucket,
+                                   Key=key,
+                                   Range="bytes={}-{}".format(range_start, range_end),
+                                   IfMatch=etag)
+      # A server that ignores the range would send the whole object instead
+      if response.get("ContentRange") != content_range:
+        raise IOError("Asked for \"{}\" of \"{}\", but got \"{}\".".format(
+            content_range, key, response.get("ContentRange")))
+      body = response["Body"].read()
+      if len(body) != range_end - range_start + 1:
+        raise IOError("Got {} bytes for \"{}\" of \"{}\".".format(len(body), content_range, key))
+      compressed_map[range_start:range_end + 1] = body
+
+    pool = ThreadPoolExecutor(max_workers=download_workers)
+    futures = [pool.submit(fetch_range, s) for s in range(start, size, range_chunk_size)]
+    try:
+      for future in as_completed(futures):
+        future.result()  # Raises the first failure here
+    finally:
+      # On failure, don't bother downloading the ranges that haven't started yet. This still waits
+      # for the ones in progress, since they write into the memory map.
+      pool.shutdown(wait=True, cancel_futures=True)
+
+
+# Downloads the gzipped file from s3 and unzips it. Returns the response of the first GET, which
+# has the object's ETag and Last-Modified time.
+# The first GET asks for the first range only, so small objects take a single request and big
+# ones get the rest of their ranges downloaded in parallel. Extra keyword arguments are passed on
+# to that GET (e.g. IfNoneMatch, which raises a "304" ClientError if the object didn't change).
+def download_gzipped(client, bucket, key, fp, **conditions):
+  response = client.get_object(Bucket=bucket,
+                               Key=key,
+                               Range="bytes=0-{}".format(range_chunk_size - 1),
+                               **conditions)
+  with tempfile.TemporaryFile() as compressed_fp:
+    shutil.copyfileobj(response["Body"], compressed_fp)
+
+    # No content range means the server ignored the range and sent the whole object anyway
+    content_range = response.get("ContentRange")
+    if content_range:
+      size = int(content_range.split("/")[-1])
+      if size > compressed_fp.tell():
+        print("Downloading {} bytes in {} byte ranges...".format(size, range_chunk_size))
+        download_ranges(client, bucket, key, compressed_fp, compressed_fp.tell(), size,
+                        response["ETag"])
+
+    compressed_fp.seek(0)
+    with gzip.GzipFile(fileobj=compressed_fp, mode='rb') as gz:
+      shutil.copyfileobj(gz, fp)
+
+  return response
+
+
+# Reads the cache of ETags & Last-Modified times of previously synced objects.
+def load_sync_cache():
+  try:
+    with open(sync_cache_file, "r") as fp:
+      return json.load(fp)
+  except (OSError, ValueError):
+    return {}
+
+
+# Saves the cache through a temporary file, so a crash never leaves half of it behind.
+def save_sync_cache(cache):
+  fd, temp_name = tempfile.mkstemp(prefix=".{}.".format(os.path.basename(sync_cache_file)),
+                                   suffix=".part",
+                                   dir=os.path.dirname(sync_cache_file) or ".")
+  try:
+    with os.fdopen(fd, "w") as fp:
+      json.dump(cache, fp, indent=2)
+    os.replace(temp_name, sync_cache_file)
+  finally:
+    if os.path.exists(temp_name):
+      os.remove(temp_name)
 
 
 # Downloads the file with the specified file name from s3.
 # Returns True if the download is successful, and False if the file was not found.
 # Raises an exception otherwise.
+# If sync is set, the object is only downloaded when it changed since the last sync (checked with
+# a conditional GET against the cached ETag), and True is also returned if it was skipped.
+# The cache is read from and saved to sync_cache_file, unless it is passed in; then it is only
+# updated in place, and saving it is up to the caller (see import_all).
+# The file is only replaced once the download is complete, so a failed download keeps the old copy.
 def download_from_s3_bucket(file_name,
                             object_name=None,
                             bucket="billing-uploads",
-                            delete_after=True):
-  # Create s3 session & client
-  session = boto3.session.Session()
-  client = session.client(service_name="s3",
-                          aws_access_key_id=aws_secrets.access_id,
-                          aws_secret_access_key=aws_secrets.access_key,
-                          endpoint_url="http://s3.wasabibeta.com")
+                            delete_after=True,
+                            sync=False,
+                            cache=None):
+  from botocore.exceptions import ClientError  # Imported here since botocore is slow to load
+  client = get_s3_client(max_pool_connections=download_workers)
 
   # Assigns to object name the file name without the extension
   if object_name is None:
     object_name, _ = os.path.splitext(os.path.basename(file_name))
 
-  try:
-    with open(file_name, 'wb') as fp:
-      # Download the gz file and unzip it
-      download_gzipped(client, bucket, object_name, fp)
-      print("Successfully downloaded file!")
+  # Only trust the cache if the local copy is still the one we downloaded
+  save_cache = sync and cache is None
+  if save_cache:
+    cache = load_sync_cache()
+  elif not sync:
+    cache = {}
+  cache_key = "{}/{}".format(bucket, object_name)
+  cached = cache.get(cache_key)
+  if cached and (cached.get("file") != file_name or not os.path.exists(file_name) or
+                 os.path.getsize(file_name) != cached.get("size") or
+                 os.path.getmtime(file_name) != cached.get("mtime")):
+    cached = None
 
-      if delete_after:
-        # Now clean up the bucket, since we no longer need the object
-        client.delete_object(Bucket=bucket, Key=object_name)
-        print("Cleaned up object from bucket.")
-      else:
-        print("Not cleaning up, for debugging")
+  # Only download the object if it changed since it was cached
+  conditions = {}
+  if cached and cached.get("etag"):
+    conditions["IfNoneMatch"] = cached["etag"]
+  elif cached and cached.get("last_modified"):
+    conditions["IfModifiedSince"] = datetime.fromisoformat(cached["last_modified"])
 
-    return True
+  # Download next to the file, then swap it in once everything went well
+  fd, temp_name = tempfile.mkstemp(prefix=".{}.".format(os.path.basename(file_name)),
+                                   suffix=".part",
+                                   dir=os.path.dirname(file_name) or ".")
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      # Download the gz file and unzip it
+      response = download_gzipped(client, bucket, object_name, fp, **conditions)
+    os.replace(temp_name, file_name)
+    print("Successfully downloaded file!")
 
   except ClientError as e:
-    # Delete our created (empty) file, since error
-    if os.path.exists(file_name):
-      print("Deleting empty file \"{}\".".format(file_name))
-      os.remove(file_name)
+    if e.response['Error']['Code'] in ("304", "NotModified"):
+      print("\"{}\" is already up to date, skipping.".format(file_name))
+      return True
     # Only catch the (common) 404 error, nothing else
-    if e.response['Error']['Code'] == "404":
+    if e.response['Error']['Code'] in ("404", "NoSuchKey"):
       print("The file does not exist.")
       return False
 
     raise
 
+  finally:
+    # Clean up the partial download, if it's still there
+    if os.path.exists(temp_name):
+      os.remove(temp_name)
+
+  if delete_after:
+    # Now clean up the bucket, since we no longer need the object
+    client.delete_object(Bucket=bucket, Key=object_name)
+    print("Cleaned up object from bucket.")
+  else:
+    print("Not cleaning up, for debugging")
+
+  # Remember what we downloaded, so that the next sync can skip it if it didn't change
+  if sync:
+    last_modified = response.get("LastModified")
+    cache[cache_key] = {
+        "file": file_name,
+        "size": os.path.getsize(file_name),
+        "mtime": os.path.getmtime(file_name),
+        "etag": response.get("ETag"),
+        "last_modified": last_modified.isoformat() if last_modified else None,
+    }
+    if save_cache:
+      save_sync_cache(cache)
+
+  return True
+
 
 # Function to be run for the daily fetch operation of the BucketUtilization table
 def daily_pull():
@@ -85,45 +219,56 @@ def daily_pull():
 
 
 # Imports all the CSV files from s3
-def import_all(from_s3=False):
-  # Download the list of files if not already provided
-  if from_s3:
-    print("Downloading the lists of tables from s3...")
-    download_from_s3_bucket(file_name="tables_global.txt",
-                            bucket="global-uploads",
-                            delete_after=False)
-    download_from_s3_bucket(file_name="tables_billing.txt",
-                            bucket="billing-uploads",
-                            delete_after=False)
+# If sync is set, only the objects that changed since the last sync are downloaded. The sync
+# cache is then loaded once, and saved every sync_cache_save_every objects and at the end.
+def import_all(from_s3=False, sync=False):
+  cache = load_sync_cache() if sync else None
+  synced = 0
 
-  # Open the files for lists of tables
-  with open("tables_global.txt", "r") as global_fp:
-    tables_global = global_fp.read().splitlines()
-  with open("tables_billing.txt", "r") as billing_fp:
-    tables_billing = billing_fp.read().splitlines()
+  # Download an object, saving the sync cache every so often so a crash doesn't lose it all
+  def download(file_name, bucket):
+    nonlocal synced
+    download_from_s3_bucket(file_name=file_name,
+                            bucket=bucket,
+                            delete_after=False,
+                            sync=sync,
+                            cache=cache)
+    synced += 1
+    if sync and synced % sync_cache_save_every == 0:
+      save_sync_cache(cache)
 
-  # Download the corresponding CSV data for BA_Global tables
-  for tbl_g in tables_global:
-    try:
-      download_from_s3_bucket(file_name="{}.csv".format(tbl_g),
-                              bucket="global-uploads",
-                              delete_after=False)
-      # Our directory is cluttered, let's clean up
-      os.rename("{}.csv".format(tbl_g), os.path.join("BA_Global", "{}.csv".format(tbl_g)))
-    except:
-      e = sys.exc_info()[0]
-      print(e)  # Keep going after
-
-  # Do the same with BA_Billing tables
-  for tbl_b in tables_billing:
-    try:
-      download_from_s3_bucket(file_name="{}.csv".format(tbl_b),
-                              bucket="billing-uploads",
-                              delete_after=False)
-      os.rename("{}.csv".format(tbl_b), os.path.join("BA_Billing", "{}.csv".format(tbl_b)))
-    except:
-      e = sys.exc_info()[0]
-      print(e)
+  try:
+    # Download the list of files if not already provided
+    if from_s3:
+      print("Downloading the lists of tables from s3...")
+      download("tables_global.txt", "global-uploads")
+      download("tables_billing.txt", "billing-uploads")
+
+    # Open the files for lists of tables
+    with open("tables_global.txt", "r") as global_fp:
+      tables_global = global_fp.read().splitlines()
+    with open("tables_billing.txt", "r") as billing_fp:
+      tables_billing = billing_fp.read().splitlines()
+
+    # Download the corresponding CSV data for BA_Global tables straight into its folder
+    for tbl_g in tables_global:
+      try:
+        download(os.path.join("BA_Global", "{}.csv".format(tbl_g)), "global-uploads")
+      except:
+        e = sys.exc_info()[0]
+        print(e)  # Keep going after
+
+    # Do the same with BA_Billing tables
+    for tbl_b in tables_billing:
+      try:
+        download(os.path.join("BA_Billing", "{}.csv".format(tbl_b)), "billing-uploads")
+      except:
+        e = sys.exc_info()[0]
+        print(e)
+
+  finally:
+    if sync:
+      save_sync_cache(cache)
 
 
 # Runs when run as a script
@@ -133,7 +278,10 @@ if __name__ == "__main__":
   dname = os.path.dirname(abspath)
   os.chdir(dname)
 
-  if len(sys.argv) > 1:
+  if "--sync" in sys.argv:
+    # Only pull down what changed since the last sync, including the lists of tables
+    import_all(from_s3=True, sync=True)
+  elif len(sys.argv) > 1:
     import_all()
   else:
     # Try to download the daily pull
@@ -1,11 +1,41 @@
 import aws_secrets
 import sys
 import os
-import boto3
 from io import BytesIO
 import gzip
 import shutil
 
+# The shared s3 client, created on first use by get_s3_client(), and its number of HTTP connections
+_client = None
+_client_pool_connections = 0
+
+
+# Returns the shared s3 client, creating it first if needed. The client keeps its own pool of
+# HTTP connections, so reusing it saves setting up a new session for every upload.
+# If the client has fewer than max_pool_connections connections (e.g. a download wants more to
+# run in parallel), it is created again with that many.
+def get_s3_client(max_pool_connections=10):
+  global _client, _client_pool_connections
+  if _client is None or _client_pool_connections < max_pool_connections:
+    # boto3 is slow to import, so only load it once we actually talk to s3
+    import boto3
+    from botocore.config import Config
+    session = boto3.session.Session()
+    _client = session.client(service_name="s3",
+                             aws_access_key_id=aws_secrets.access_id,
+                             aws_secret_access_key=aws_secrets.access_key,
+                             endpoint_url="http://s3.wasabibeta.com",
+                             config=Config(max_pool_connections=max_pool_connections))
+    _client_pool_connections = max_pool_connections
+  return _client
+
+
+# Throws away the shared s3 client, so the next call to get_s3_client() reconnects.
+def reset_s3_client():
+  global _client, _client_pool_connections
+  _client = None
+  _client_pool_connections = 0
+
 
 # Uploads the file to s3 as a gzipped file.
 def upload_gzipped(client, bucket, key, fp, compressed_fp=None, content_type='text/plain'):
@@ -39,12 +69,7 @@ def delete_bucket_contents(client, bucket):
 # Uploads the file to s3 and lists the number of objects in the bucket after the
 # operation.
 def upload_to_s3_bucket(file_name, bucket="billing-uploads"):
-  # Create s3 session & client
-  session = boto3.session.Session()
-  client = session.client(service_name="s3",
-                          aws_access_key_id=aws_secrets.access_id,
-                          aws_secret_access_key=aws_secrets.access_key,
-                          endpoint_url="http://s3.wasabibeta.com")
+  client = get_s3_client()
 
   # Assigns to object name the file name without the extension
   object_name, _ = os.path.splitext(os.path.basename(file_name))
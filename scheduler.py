@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from mysql_connect import db_config, daily_routine, export_all, export_schemas
+from s3_upload import get_s3_client, reset_s3_client
+
+# File to which the scheduler writes its status after every job
+status_file = "scheduler-status.json"
+
+# Seconds to wait before retrying a failed job, doubled after every consecutive failure
+retry_delay = 30
+
+
+# A single operation run by the scheduler every "interval" seconds, along with its last-run metrics.
+# retry_kwargs override kwargs when retrying after a failure, and jobs sharing the same lock never
+# run at the same time.
+class Job:
+
+  def __init__(self, name, interval, operation, retry_kwargs=None, lock=None, **kwargs):
+    self.name = name
+    self.interval = interval
+    self.operation = operation  # Must take in a connection, just like with connect_to_db()
+    self.kwargs = kwargs
+    self.retry_kwargs = retry_kwargs or {}
+    self.lock = lock
+    self.thread = None  # The thread running the job, while it runs
+    self.next_run = time.time()  # Everything runs once right after startup
+    self.last_run = None
+    self.last_duration = None
+    self.last_status = None
+    self.last_error = None
+    self.runs = 0
+    self.failures = 0
+    self.consecutive_failures = 0
+
+  def running(self):
+    return self.thread is not None and self.thread.is_alive()
+
+  def status(self):
+    return {
+        "running": self.running(),
+        "interval_seconds": self.interval,
+        "next_run": str(datetime.fromtimestamp(self.next_run).replace(microsecond=0)),
+        "last_run": str(self.last_run) if self.last_run else None,
+        "last_duration_seconds": self.last_duration,
+        "last_status": self.last_status,
+        "last_error": self.last_error,
+        "runs": self.runs,
+        "failures": self.failures,
+        "consecutive_failures": self.consecutive_failures,
+    }
+
+
+# Keeps warm MySQL and s3 connections around and runs the jobs on their own schedules, instead of
+# having cron start up a new process (and new connections) for every run.
+# Every job runs on its own thread, so a long export doesn't hold up the others.
+class Scheduler:
+
+  # A health_interval of 0 disables the health checks.
+  # pool_size defaults to one connection per job, plus one for the health checks.
+  def __init__(self, host, db="BA_Billing", pool_size=None, health_interval=300):
+    self.host = host
+    self.db = db
+    self.pool_size = pool_size
+    self.health_interval = health_interval
+    self.pool = None
+    self.pool_lock = threading.Lock()  # So that only one thread creates the pool
+    self.jobs = []
+    self.started = datetime.now().replace(microsecond=0)
+    self.health = {"last_check": None, "mysql": None, "s3": None}
+    self.next_health_check = time.time() + health_interval if health_interval else None
+    self.stop_event = threading.Event()
+    self.wake_event = threading.Event()  # Set when a job finishes, so its next run gets scheduled
+    self.lock = threading.Lock()  # Guards the status, which is read from other threads
+
+  def add_job(self, name, interval, operation, **kwargs):
+    self.jobs.append(Job(name, interval, operation, **kwargs))
+
+  # Hands out a connection from the pool, creating the pool first if needed.
+  # The pool itself checks that the connection is still alive, and reconnects if it went stale
+  # (giving the connection back if that fails, so the pool doesn't run dry while MySQL is down).
+  def get_connection(self):
+    import mysql.connector.pooling as pooling  # Slow to import, see connect_to_db()
+
+    with self.pool_lock:
+      if self.pool is None:
+        pool_size = self.pool_size or len(self.jobs) + 1
+        print("Creating a pool of {} connections to {} for database \"{}\"...".format(
+            pool_size, self.host, self.db))
+        self.pool = pooling.MySQLConnectionPool(pool_name="mysql-data-transfer",
+                                                pool_size=pool_size,
+                                                **db_config(self.host, self.db))
+    return self.pool.get_connection()
+
+  # Checks that both MySQL and s3 are reachable, dropping the s3 client if it is not.
+  def health_check(self):
+    now = datetime.now().replace(microsecond=0)
+    health = {"last_check": str(now)}
+
+    try:
+      cnx = self.get_connection()
+      cnx.close()  # Returns it to the pool
+      health["mysql"] = "ok"
+    except Exception as err:
+      health["mysql"] = str(err)
+
+    try:
+      get_s3_client().list_buckets()
+      health["s3"] = "ok"
+    except Exception as err:
+      reset_s3_client()
+      health["s3"] = str(err)
+
+    print("[{}] Health check: MySQL {}, s3 {}.".format(now, health["mysql"], health["s3"]))
+    with self.lock:
+      self.health = health
+
+  # Runs a single job with a pooled connection and records how it went.
+  def run_job(self, job):
+    start = time.time()
+    last_run = datetime.now().replace(microsecond=0)
+    with self.lock:
+      job.last_run = last_run
+      kwargs = dict(job.kwargs)
+      if job.consecutive_failures:
+        kwargs.update(job.retry_kwargs)
+    print("\n[{}] Running job \"{}\"...".format(last_run, job.name))
+
+    try:
+      if job.lock:
+        job.lock.acquire()
+      try:
+        cnx = self.get_connection()
+        try:
+          job.operation(cnx, **kwargs)
+        finally:
+          cnx.close()  # Returns it to the pool
+      finally:
+        if job.lock:
+          job.lock.release()
+      status, error = "ok", None
+    except Exception as err:
+      # The s3 client might be what broke, so start fresh with it next time
+      reset_s3_client()
+      status, error = "failed", str(err)
+      print("[{}] Job \"{}\" failed: {}".format(datetime.now().replace(microsecond=0), job.name,
+                                               err))
+
+    with self.lock:
+      job.last_duration = round(time.time() - start, 3)
+      job.last_status = status
+      job.last_error = error
+      job.runs += 1
+      if error:
+        # Retry soon rather than waiting a whole interval (e.g. a day for the GDB export), backing
+        # off after every consecutive failure, but never waiting longer than usual
+        job.failures += 1
+        job.consecutive_failures += 1
+        max_delay = min(job.interval, self.health_interval or job.interval)
+        delay = min(retry_delay * 2**(job.consecutive_failures - 1), max_delay)
+        job.next_run = time.time() + delay
+        print("Retrying job \"{}\" in {} seconds.".format(job.name, round(delay)))
+      else:
+        job.consecutive_failures = 0
+        job.next_run = start + job.interval
+    self.write_status()
+    self.wake_event.set()
+
+  def status(self):
+    with self.lock:
+      return {
+          "host": self.host,
+          "started": str(self.started),
+          "health": dict(self.health),
+          "jobs": {job.name: job.status() for job in self.jobs},
+      }
+
+  # Writes the status to status_file. Failing to do so (e.g. full disk) shouldn't kill the daemon.
+  # It's written to a temporary file first and then swapped in, so readers never see half of it.
+  def write_status(self):
+    try:
+      fd, temp_name = tempfile.mkstemp(prefix=".{}.".format(os.path.basename(status_file)),
+                                       suffix=".part",
+                                       dir=os.path.dirname(status_file) or ".")
+      try:
+        with os.fdopen(fd, "w") as fp:
+          json.dump(self.status(), fp, indent=2)
+        os.replace(temp_name, status_file)
+      finally:
+        if os.path.exists(temp_name):
+          os.remove(temp_name)
+    except OSError as err:
+      print("[{}] Couldn't write the status to \"{}\": {}".format(
+          datetime.now().replace(microsecond=0), status_file, err))
+
+  # Serves the status as JSON over HTTP on the given host & port, from a background thread.
+  # There is no authentication, so by default it is only reachable from this machine.
+  def serve_status(self, port, host="127.0.0.1"):
+    scheduler = self
+
+    class StatusHandler(BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        body = json.dumps(scheduler.status(), indent=2).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass  # Don't clutter the scheduler's output with every request
+
+    server = HTTPServer((host, port), StatusHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print("Serving scheduler status on {}:{}.".format(host, port))
+
+  # Main loop: starts whatever is due on its own thread, then sleeps until the next job (or health
+  # check) is due, or until a job finishes.
+  def run_forever(self):
+    self.write_status()
+    while not self.stop_event.is_set():
+      self.wake_event.clear()
+      for job in self.jobs:
+        if not job.running() and time.time() >= job.next_run:
+          job.thread = threading.Thread(target=self.run_job, args=(job,), name=job.name)
+          job.thread.start()
+
+      if self.next_health_check and time.time() >= self.next_health_check:
+        self.health_check()
+        self.write_status()
+        self.next_health_check = time.time() + self.health_interval
+
+      # Running jobs get scheduled again once they finish, which sets wake_event
+      due = [job.next_run for job in self.jobs if not job.running()]
+      if self.next_health_check:
+        due.append(self.next_health_check)
+      timeout = max(0, min(due) - time.time()) if due else None
+      self.wake_event.wait(timeout)
+
+    for job in self.jobs:
+      if job.running():
+        job.thread.join()
+    print("Scheduler stopped.")
+
+  def stop(self, *_):
+    print("Stopping the scheduler after the running jobs...")
+    self.stop_event.set()
+    self.wake_event.set()
+
+
+# Runs when the code is run as a script.
+if __name__ == "__main__":
+  # Changes the working directory to be relative to the current file's folder
+  abspath = os.path.abspath(__file__)
+  dname = os.path.dirname(abspath)
+  os.chdir(dname)
+
+  parser = argparse.ArgumentParser(
+      description="Long-running daemon that runs the MySQL exports on internal schedules.")
+  parser.add_argument("--host",
+                      type=str,
+                      default="db01.ashburn",
+                      help="The DB hostname, default db01.ashburn")
+  parser.add_argument("--bucket-util-interval",
+                      type=int,
+                      default=10,
+                      help="Minutes between BucketUtilization exports, default 10")
+  parser.add_argument("--export-gdb-interval",
+                      type=int,
+                      default=1440,
+                      help="Minutes between incremental GDB exports, default 1440 (daily). \
+                      Set to 0 to disable")
+  parser.add_argument("--export-schemas-interval",
+                      type=int,
+                      default=1440,
+                      help="Minutes between schema refreshes, default 1440 (daily). \
+                      Set to 0 to disable")
+  parser.add_argument("--health-interval",
+                      type=int,
+                      default=5,
+                      help="Minutes between MySQL and s3 health checks, default 5. \
+                      Set to 0 to disable")
+  parser.add_argument("--pool-size",
+                      type=int,
+                      default=None,
+                      help="Number of pooled MySQL connections, default one per job plus one \
+                      for the health checks")
+  parser.add_argument("--status-port",
+                      type=int,
+                      default=None,
+                      help="If set, serve the scheduler status as JSON over HTTP on this port")
+  parser.add_argument("--status-host",
+                      type=str,
+                      default="127.0.0.1",
+                      help="Address to serve the status on, default 127.0.0.1 (this machine only). \
+                      The status is not authenticated, so be careful exposing it")
+  args = parser.parse_args()
+  if min(args.bucket_util_interval, args.export_gdb_interval, args.export_schemas_interval,
+         args.health_interval) < 0:
+    parser.error("Intervals can't be negative.")
+  if args.pool_size is not None and args.pool_size < 1:
+    parser.error("--pool-size must be at least 1.")
+
+  scheduler = Scheduler(host=args.host,
+                        pool_size=args.pool_size,
+                        health_interval=args.health_interval * 60)
+  if args.bucket_util_interval:
+    scheduler.add_job("export-BucketUtilization", args.bucket_util_interval * 60, daily_routine)
+  # The GDB export and the schema refresh both go through tables_*.txt, so never run them together
+  gdb_lock = threading.Lock()
+  # Incremental export: picks up from the last autoinc values, and ignores tables_done.txt
+  # (starting it over every run), since otherwise every table would be skipped after the first run.
+  # A retry after a failure does use tables_done.txt, so that the tables already uploaded by the
+  # failed run aren't exported (and overwritten in s3) again before they were pulled.
+  if args.export_gdb_interval:
+    scheduler.add_job("export-gdb",
+                      args.export_gdb_interval * 60,
+                      export_all,
+                      retry_kwargs={"ignore_tables_done": False},
+                      lock=gdb_lock,
+                      start_from_scratch=False,
+                      ignore_tables_done=True)
+  # Added after export-gdb, so at startup it normally waits for the freshly written tables_*.txt
+  if args.export_schemas_interval:
+    scheduler.add_job("export-schemas",
+                      args.export_schemas_interval * 60,
+                      export_schemas,
+                      lock=gdb_lock)
+
+  if not scheduler.jobs:
+    print("All the jobs are disabled, nothing to do.")
+    sys.exit(1)
+
+  signal.signal(signal.SIGTERM, scheduler.stop)
+  signal.signal(signal.SIGINT, scheduler.stop)
+
+  if args.status_port:
+    scheduler.serve_status(args.status_port, host=args.status_host)
+
+  scheduler.run_forever()